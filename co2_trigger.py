@@ -1,47 +1,100 @@
+import atexit
 from collections import deque
-import json
+from math import sqrt
+import orjson
+import os
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from rich.console import Console
-from statistics import stdev, mean
-from time import monotonic
+from time import monotonic, sleep
 
 from decision import Decision
 
 
 UPDATE_INTERVAL = 30 * 60  # 30 minutes
 DEQUE_SIZE = 36 * 2    # 2 readings an hour for a day and a half.
+REQUEST_TIMEOUT = 10 # Seconds
+FLUSH_EVERY = 4 # Readings held in memory before being written to disk
+RETRY_DELAYS = (0.5, 1, 2) # Seconds to wait before each retry of a failed CO2Signal request
+
+
+class ReadingWindow:
+    """Fixed-size window of readings that keeps a running sum and sum of squares,
+    so mean and standard deviation don't need a pass over the whole window."""
+    def __init__(self, readings=(), size:int=DEQUE_SIZE):
+        self._readings = deque([], size)
+        self._sum = 0
+        self._sumsq = 0
+        for reading in readings:
+            self.append(reading)
+
+    def append(self, reading):
+        if len(self._readings) == self._readings.maxlen:
+            evicted = self._readings[0]
+            self._sum -= evicted
+            self._sumsq -= evicted * evicted
+        self._readings.append(reading)
+        self._sum += reading
+        self._sumsq += reading * reading
+
+    def mean(self) -> float:
+        return self._sum / len(self._readings)
+
+    def stdev(self) -> float:
+        n = len(self._readings)
+        variance = (self._sumsq - self._sum * self._sum / n) / (n - 1)
+        return sqrt(max(variance, 0))
+
+    def tolist(self) -> list:
+        return list(self._readings)
+
+    def __len__(self):
+        return len(self._readings)
+
+    def __iter__(self):
+        return iter(self._readings)
+
+    def __getitem__(self, index):
+        return self._readings[index]
 
 
 class CO2Trigger:
     def __init__(self, region:str, api_key:str, data_location:Path, console:Console):
-        self._key = api_key
+        self._session = requests.Session()
+        self._session.headers["auth-token"] = api_key
+        self._session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
         self.data_location = data_location
         self.next_update = monotonic()
-        self.data = deque([], DEQUE_SIZE)
+        self.data = ReadingWindow()
         self.region = region
         self.console = console
+        self._dirty_count = 0
+        self._etag = None
+        atexit.register(self._flush)
 
 
     def load_data(self):
-        with open(self.data_location) as in_file:
-            self.data = deque(json.load(in_file), DEQUE_SIZE)
+        self.data = ReadingWindow(int(reading) for reading in orjson.loads(self.data_location.read_bytes()))
 
 
     def update_data(self):
         if monotonic() < self.next_update:
             return
 
-        api_response = requests.get(
-            f"https://api.co2signal.com/v1/latest?countryCode={self.region}",
-            headers={"auth-token": self._key})
+        api_response = self._fetch()
+        if api_response is None:
+            return
 
-        #self.console.print(api_response.json())
+        if api_response.status_code == 304 and len(self.data) > 0:
+            # Intensity hasn't changed since the last reading, so repeat it to keep the cadence.
+            self._record(self.data[-1])
+            return
 
         try:
-            json_response = api_response.json()
-        except JSONDecodeError as e:
-            self.console.log(f"Unexpected response (invalid json) from {api_response.code()} {api_response.text()}. Skipping CO2Signal update")
+            json_response = orjson.loads(api_response.content)
+        except orjson.JSONDecodeError as e:
+            self.console.log(f"Unexpected response (invalid json) from {api_response.status_code} {api_response.text}. Skipping CO2Signal update")
             return
 
         co2eq = json_response.get("data", {}).get("carbonIntensity", None)
@@ -49,20 +102,57 @@ class CO2Trigger:
             self.console.log(f"Unable to get carbon intensity from response: {json_response}. Skipping CO2Signal update")
             return
 
-        co2eq = api_response.json()["data"]["carbonIntensity"]
-
+        self._etag = api_response.headers.get("ETag")
+        self._record(int(co2eq))
+
+    def _fetch(self):
+        headers = {"If-None-Match": self._etag} if self._etag else {}
+        for delay in (*RETRY_DELAYS, None):
+            try:
+                api_response = self._session.get(
+                    f"https://api.co2signal.com/v1/latest?countryCode={self.region}",
+                    headers=headers,
+                    timeout=REQUEST_TIMEOUT)
+                if api_response.status_code < 500:
+                    return api_response
+                error = f"{api_response.status_code} {api_response.reason}"
+            except requests.RequestException as e:
+                error = e
+
+            if delay is None:
+                break
+            sleep(delay)
+
+        self.console.log(f"Unable to reach CO2Signal after {len(RETRY_DELAYS) + 1} attempts: {error}. Skipping CO2Signal update")
+        return None
+
+    def _record(self, co2eq):
         self.next_update = monotonic() + UPDATE_INTERVAL
         self.data.append(co2eq)
-        with open(self.data_location, "w") as out_file:
-            json.dump(list(self.data), out_file)
+        self._dirty_count += 1
+        if self._dirty_count >= FLUSH_EVERY:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._session.close()
+
+    def _flush(self):
+        if self._dirty_count == 0:
+            return
+
+        tmp_location = self.data_location.with_suffix(".json.tmp")
+        tmp_location.write_bytes(orjson.dumps(self.data.tolist()))
+        os.replace(tmp_location, self.data_location)
+        self._dirty_count = 0
 
     def decide(self) -> Decision:
         if len(self.data) < 2:
             self.console.log(f":heavy_check_mark: Still initializing CO2 thresholds")
             return False
 
-        last_co2 = int(self.data[-1])
-        threshold = int(mean(self.data) + stdev(self.data))
+        last_co2 = self.data[-1]
+        threshold = int(self.data.mean() + self.data.stdev())
         is_high = last_co2 >= threshold
         check = ":heavy_multiplication_x:" if is_high else ":heavy_check_mark:"
         self.console.log(f"{check} Current gCO2eq/kWh ({last_co2:.1f}) should be less than threshold {threshold:.1f}")
@@ -71,7 +161,7 @@ class CO2Trigger:
             name="Carbon Cost",
             criteria="Carbon cost less than x̅ + σ",
             units="gCO2eq/kWh",
-            threshold=int(threshold),
-            measurement=int(last_co2),
+            threshold=threshold,
+            measurement=last_co2,
             decision=(not is_high)
         )
@@ -2,6 +2,8 @@ from dataclasses import dataclass
 
 @dataclass
 class Decision:
+    __slots__ = ("name", "criteria", "units", "threshold", "measurement", "decision")
+
     name: str
     criteria: str
     units: str
@@ -1,9 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from os import getenv
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+import signal
 import socket
-from time import sleep
+import threading
+from time import monotonic
 
 from dotenv import load_dotenv
 from rich.console import Console
@@ -17,6 +21,10 @@ from decision import Decision
 
 
 DEVICE_DRAW_THRESHOLD = 50 # Watts
+WEBHOOK_TIMEOUT = 5 # Seconds
+SENSE_INTERVAL = 120 # Seconds
+MIN_SLEEP = 5 # Seconds
+TABLE_COLUMNS = ("Item", "Criteria", "Threshold", "Current Value", "Go / No Go")
 
 
 class DeviceState(Enum):
@@ -31,29 +39,64 @@ class Controller:
         self.live = live
         self.sense_device = sense_device
         self.device_state = DeviceState.UNKNOWN
-        self.webhook_key = webhook_key
         self.co2_trigger = co2_trigger
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._pool = ThreadPoolExecutor(max_workers=2)
+        self._urls = {
+            True: f"https://maker.ifttt.com/trigger/dehumidifier_on/with/key/{webhook_key}",
+            False: f"https://maker.ifttt.com/trigger/dehumidifier_off/with/key/{webhook_key}",
+        }
+        self._states = {True: DeviceState.ON, False: DeviceState.OFF}
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
 
     def run(self):
-        while(True):
-            #with self.live.console.status("Fetching CO2 data"):
-            self.co2_trigger.update_data()
-
-            decisions = [self.co2_trigger.decide(), self.decide_device()]
-            dehumidifier_should_be_on = decisions[0].decision and decisions[1].decision
-            self.update_device(dehumidifier_should_be_on)
-
-            sleep_duration = 120
-            co2_is_high = not decisions[0].decision
-            if co2_is_high:
-                sleep_duration = 1800
-                self.live.console.log("CO2 is high. Will pause and check back in 30 minutes")
+        try:
+            while not self._stop.is_set():
+                co2_future = None
+                if monotonic() >= self.co2_trigger.next_update:
+                    co2_future = self._pool.submit(self.co2_trigger.update_data)
+                sense_future = self._pool.submit(self._fetch_sense)
+                if co2_future is not None:
+                    co2_future.result()
+                realtime_data = sense_future.result()
+
+                decisions = [self.co2_trigger.decide(), self.decide_device(realtime_data)]
+                dehumidifier_should_be_on = decisions[0].decision and decisions[1].decision
+                self.update_device(dehumidifier_should_be_on)
+
+                co2_due_in = self.co2_trigger.next_update - monotonic()
+                if co2_due_in <= 0 and co2_future is not None:
+                    # The CO2 update ran this pass and failed, retry on the usual cadence.
+                    co2_due_in = SENSE_INTERVAL
+                sleep_duration = min(SENSE_INTERVAL, max(MIN_SLEEP, co2_due_in))
+                co2_is_high = not decisions[0].decision
+                if co2_is_high:
+                    sleep_duration = 1800
+                    self.live.console.log("CO2 is high. Will pause and check back in 30 minutes")
+
+                live.update(self.generate_table(decisions), refresh=True)
+                self._stop.wait(sleep_duration)
+        finally:
+            self.live.console.log("Shutting down")
+            self._pool.shutdown()
+            self.co2_trigger.close()
+            self._http.close()
+
+
+    def _fetch_sense(self):
+        try:
+            self.sense_client.update_realtime()
+            return self.sense_client.get_realtime()
+        except (SenseAPITimeoutException, socket.timeout) as e:
+            self.live.console.log(f"Transient Exception connecting to Sense API.  Reading as {self.sense_device} off for now: {e}")
+            return None
 
-            live.update(self.generate_table(decisions), refresh=True)
-            sleep(sleep_duration)
 
-    
-    def decide_device(self) -> Decision:
+    def decide_device(self, realtime_data) -> Decision:
         decision = Decision(
             name=self.sense_device,
             criteria="Projector should be off",
@@ -63,40 +106,25 @@ class Controller:
             decision=True
         )
 
-        #with self.live.console.status("Fetching Sense data"):
-        try:
-            self.sense_client.update_realtime()
-            realtime_data = self.sense_client.get_realtime()
-        except (SenseAPITimeoutException, socket.timeout) as e:
-            self.live.console.log(f"Transient Exception connecting to Sense API.  Reading as {self.sense_device} off for now: {e}")
+        if realtime_data is None:
             return decision
 
-
-        for device in realtime_data["devices"]:
-            device_name = device["name"]
-            if device_name != self.sense_device:
-                continue
-
-            device_draw = device["w"]
-            device_is_on = device_draw > DEVICE_DRAW_THRESHOLD
-            check = ":heavy_multiplication_x:" if device_is_on else ":heavy_check_mark:"
-            self.live.console.log(f"{check} {device_name} ({device_draw:.1f} Watts) should be less than {DEVICE_DRAW_THRESHOLD} Watts")
-            decision.measurement = device_draw
-            decision.decision = not device_is_on
+        device = next((d for d in realtime_data["devices"] if d["name"] == self.sense_device), None)
+        if device is None:
+            self.live.console.log(f":heavy_check_mark: {self.sense_device} missing, inferred (0W) < {DEVICE_DRAW_THRESHOLD}W")
             return decision
 
-        self.live.console.log(f":heavy_check_mark: {self.sense_device} missing, inferred (0W) < {DEVICE_DRAW_THRESHOLD}W")
+        device_draw = device["w"]
+        device_is_on = device_draw > DEVICE_DRAW_THRESHOLD
+        check = ":heavy_multiplication_x:" if device_is_on else ":heavy_check_mark:"
+        self.live.console.log(f"{check} {self.sense_device} ({device_draw:.1f} Watts) should be less than {DEVICE_DRAW_THRESHOLD} Watts")
+        decision.measurement = device_draw
+        decision.decision = not device_is_on
         return decision
 
 
     def generate_table(self, decisions) -> Table:
-        result = Table(
-            "Item",
-            "Criteria",
-            "Threshold",
-            "Current Value",
-            "Go / No Go"
-        )
+        result = Table(*TABLE_COLUMNS)
         for decision in decisions:
             result.add_row(
                 decision.name, 
@@ -110,25 +138,15 @@ class Controller:
 
 
     def update_device(self, on:bool):
-        event = "dehumidifier_on" if on else "dehumidifier_off"
-        next_state = DeviceState.ON if on else DeviceState.OFF
-        webhook_url = f"https://maker.ifttt.com/trigger/{event}/with/key/{self.webhook_key}"
-
-        fire_update = False
-        if self.device_state == DeviceState.ON and not on:
-            fire_update = True
-
-        elif self.device_state == DeviceState.OFF and on:
-            fire_update = True
-
-        elif self.device_state == DeviceState.UNKNOWN:
-            fire_update = True
-
-        if fire_update:
-            #with self.live.console.status(f"Emitting '{event}' to affect change"):
-            requests.get(webhook_url)
-
-            self.live.console.log(f"Dehumidifier should be {'on' if on else 'off'}, but was {self.device_state.value}, so fired event")
+        next_state = self._states[on]
+        if self.device_state is not next_state:
+            try:
+                self._http.get(self._urls[on], timeout=WEBHOOK_TIMEOUT)
+            except requests.RequestException as e:
+                self.live.console.log(f"Unable to fire dehumidifier {next_state.value} event, will retry next pass: {e}")
+                return
+
+            self.live.console.log(f"Dehumidifier should be {next_state.value}, but was {self.device_state.value}, so fired event")
             self.device_state = next_state
 
 
@@ -146,4 +164,5 @@ if __name__ == "__main__":
             co2_trigger.load_data()
 
         controller = Controller(co2_trigger, sense_client, getenv("WEBHOOK_KEY"), getenv("TRIGGER_DEVICE"), live)
+        signal.signal(signal.SIGTERM, lambda *_: controller.stop())
         controller.run()